@@ -2,98 +2,161 @@ import logging
 import os
 import time
 import json
+import orjson
 import requests
 import azure.functions as func
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import MISSING, dataclass, fields
 from typing import Optional
-from pydantic import BaseModel, ValidationError
+from requests.adapters import HTTPAdapter
 from telegram import Bot
+from telegram.error import InvalidToken
+from urllib3.util.retry import Retry
 
-logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 TESLA_API_BASE = "https://owner-api.teslamotors.com/api/1/vehicles"
 TELEGRAM_CONFIG = os.path.join(os.path.dirname(os.path.realpath(__file__)), "telegram_config.json")
 TIMEOUT_WAKEUP = 30
-TELEGRAM_BOT = None
-TELEGRAM_CHAT_ID = None
+WAKEUP_DELAY_MIN = 0.5
+WAKEUP_DELAY_MAX = 8
+# (connect, read) timeouts in seconds for calls to the Tesla API
+TIMEOUT_COMMAND = (3.05, 10)
+TIMEOUT_WAKEUP_POLL = (3.05, 5)
+# Telegram notifications are sent in the background, so they don't delay the response to the Shortcut
+TELEGRAM_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+# INPUT_CMD -> (Tesla API command, body params); a (body param, RequestModel field) tuple instead of a dict
+# sends the value taken from the request
 COMMAND_ADAPTER = {
-    "wake_up": "wake_up",
-    "stop_hvac": "auto_conditioning_stop",
-    "start_hvac": "auto_conditioning_start",
-    "start_hvac_max": "set_preconditioning_max",
-    "set_temps": "set_temps",
-    "honk_horn": "honk_horn",
-    "flash_lights": "flash_lights",
-    "actuate_trunk": "actuate_trunk",
-    "actuate_frunk": "actuate_trunk",
-    "start_remote_drive": "remote_start_drive",
-    "start_sentry": "set_sentry_mode",
-    "stop_sentry": "set_sentry_mode",
-    "start_valet_mode": "set_valet_mode",
-    "stop_valet_mode": "set_valet_mode",
-    "unlock_doors": "door_unlock",
-    "lock_doors": "door_lock",
-    "open_charge_port_door": "charge_port_door_open",
-    "close_charge_port_door": "charge_port_door_close",
-    "start_charging": "charge_start",
-    "stop_charging": "charge_stop",
-    "set_charge_limit": "set_charge_limit",
-    "charge_standard": "charge_standard",
-    "charge_max_range": "charge_max_range",
-    "close_windows": "window_control",
-    "vent_windows": "window_control"
+    "wake_up": ("wake_up", {}),
+    "stop_hvac": ("auto_conditioning_stop", {}),
+    "start_hvac": ("auto_conditioning_start", {}),
+    "start_hvac_max": ("set_preconditioning_max", {}),
+    "set_temps": ("set_temps", ("driver_temp", "VEHICLE_TEMP")),
+    "honk_horn": ("honk_horn", {}),
+    "flash_lights": ("flash_lights", {}),
+    "actuate_trunk": ("actuate_trunk", {"which_trunk": "rear"}),
+    "actuate_frunk": ("actuate_trunk", {"which_trunk": "front"}),
+    "start_remote_drive": ("remote_start_drive", {}),
+    "start_sentry": ("set_sentry_mode", {"on": True}),
+    "stop_sentry": ("set_sentry_mode", {"on": False}),
+    "start_valet_mode": ("set_valet_mode", {"on": True}),
+    "stop_valet_mode": ("set_valet_mode", {"on": False}),
+    "unlock_doors": ("door_unlock", {}),
+    "lock_doors": ("door_lock", {}),
+    "open_charge_port_door": ("charge_port_door_open", {}),
+    "close_charge_port_door": ("charge_port_door_close", {}),
+    "start_charging": ("charge_start", {}),
+    "stop_charging": ("charge_stop", {}),
+    "set_charge_limit": ("set_charge_limit", ("percent", "VEHICLE_CHARGE_LIMIT")),
+    "charge_standard": ("charge_standard", {}),
+    "charge_max_range": ("charge_max_range", {}),
+    "close_windows": ("window_control", {"command": "close", "lat": 0, "lon": 0}),
+    "vent_windows": ("window_control", {"command": "vent", "lat": 0, "lon": 0})
 }
 
 
-class RequestModel(BaseModel):
+def __create_session(retry: Retry):
+    session = requests.Session()
+    session.headers.update({"Accept": "application/json"})
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return session
+
+
+# Shared sessions, so the connection to the Tesla API is kept alive across invocations of a warm worker.
+# Commands (e.g. actuate_trunk, honk_horn) are not safe to send twice, so they are only retried if they
+# never reached Tesla. The wake_up poll is idempotent and may also be retried on read errors and gateway errors.
+SESSION = __create_session(Retry(total=2, connect=2, read=0, backoff_factor=0.3))
+WAKEUP_SESSION = __create_session(Retry(total=2, connect=2, read=2, backoff_factor=0.3,
+                                        status_forcelist=(502, 503, 504),
+                                        allowed_methods=frozenset(["POST"]),
+                                        raise_on_status=False))
+
+
+class ValidationError(ValueError):
+    pass
+
+
+@dataclass(slots=True)
+class RequestModel:
     TOKEN: str
     VEHICLE_ID: str
     INPUT_CMD: str
     VEHICLE_TEMP: Optional[str] = None
     VEHICLE_CHARGE_LIMIT: Optional[str] = None
-    FORCE_WAKEUP: Optional[bool] = False
+    FORCE_WAKEUP: bool = False
+
+    @classmethod
+    def validate(cls, body: dict) -> "RequestModel":
+        if type(body) is not dict:
+            raise ValidationError("request body must be a JSON object")
+
+        values = {}
+        for name, is_bool, required in REQUEST_FIELDS:
+            value = body.get(name)
+            if value is None:
+                if required:
+                    raise ValidationError("%s: field required" % name)
+                continue
+
+            if is_bool:
+                if type(value) is not bool:
+                    raise ValidationError("%s: value is not a valid boolean" % name)
+            elif type(value) in (int, float):
+                # Shortcuts sends numbers for temperature and charge limit
+                value = str(value)
+            elif type(value) is not str:
+                raise ValidationError("%s: str type expected" % name)
+
+            values[name] = value
+
+        return cls(**values)
+
+
+# (name, is bool, is required) per RequestModel field, resolved once instead of on every validation
+REQUEST_FIELDS = tuple((field.name, field.type is bool, field.default is MISSING) for field in fields(RequestModel))
 
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Python HTTP trigger function processed a request.')
+    logger.info('Python HTTP trigger function processed a request.')
 
     if req.method == "GET":
         return respond("Tesla API Relay running successfully")
     elif req.method == "POST":
         try:
-            setup_telegram()
-            return parse_post_request(req.get_json())
+            return parse_post_request(req.get_body())
         except Exception as e:
-            logging.exception(e)
+            logger.exception(e)
             return respond("Server error %s" % str(e), status_code=500)
     else:
         return respond("Unsupported method %s" % req.method, status_code=400)
 
 
-def parse_post_request(body: str):
+def parse_post_request(body: bytes):
     try:
-        model = RequestModel.parse_obj(body)
-    except ValidationError as e:
-        logging.exception(e)
+        model = RequestModel.validate(orjson.loads(body))
+    except (orjson.JSONDecodeError, ValidationError) as e:
+        logger.exception(e)
         return respond("Validation error %s" % e, status_code=400)
 
     if model.INPUT_CMD not in COMMAND_ADAPTER:
         return respond("Unknown command %s" % model.INPUT_CMD, status_code=400, command=model.INPUT_CMD)
 
+    auth_headers = {"Authorization": f"Bearer {model.TOKEN}"}
     if model.FORCE_WAKEUP:
         try:
-            force_wakeup(model)
+            force_wakeup(model.VEHICLE_ID, auth_headers)
         except (TimeoutError, KeyError) as e:
             return respond({"Error while waking up": str(e)}, status_code=502, command=model.INPUT_CMD)
 
-    command_translated = COMMAND_ADAPTER[model.INPUT_CMD]
-    logging.info(os.path.join(TESLA_API_BASE, model.VEHICLE_ID, "command", command_translated))
-    logging.info(gather_body_params(model.INPUT_CMD, command_translated, model))
-    resp = requests.post(os.path.join(TESLA_API_BASE, model.VEHICLE_ID, "command", command_translated),
-                         json=gather_body_params(model.INPUT_CMD, command_translated, model),
-                         headers={"Authorization": "Bearer %s" % model.TOKEN})
+    command_translated, body_params = resolve_command(model)
+    url = f"{TESLA_API_BASE}/{model.VEHICLE_ID}/command/{command_translated}"
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("POST %s body=%s", url, body_params)
+    resp = SESSION.post(url, json=body_params, headers=auth_headers, timeout=TIMEOUT_COMMAND)
 
-    response_content = resp.json()
+    response_content = orjson.loads(resp.content)
     if not resp.ok:
         if resp.status_code == 401:
             return respond("Unauthorized. Access Token or Vehicle ID seems to be wrong!",
@@ -107,69 +170,58 @@ def parse_post_request(body: str):
             return respond("Command %s executed successfully" % model.INPUT_CMD, command=model.INPUT_CMD)
 
 
-def gather_body_params(command: str, command_translated: str, model: RequestModel):
-    if command_translated == "actuate_trunk":
-        if command == "actuate_frunk":
-            return {"which_trunk": "front"}
-        elif command == "actuate_trunk":
-            return {"which_trunk": "rear"}
-
-    if command_translated == "set_sentry_mode":
-        if command == "start_sentry":
-            return {"on": True}
-        elif command == "stop_sentry":
-            return {"on": False}
-
-    if command_translated == "set_valet_mode":
-        if command == "start_valet_mode":
-            return {"on": True}
-        elif command == "stop_valet_mode":
-            return {"on": False}
-
-    if command_translated == "window_control":
-        if command == "close_windows":
-            return {"command": "close", "lat": 0, "lon": 0}
-        elif command == "vent_windows":
-            return {"command": "vent", "lat": 0, "lon": 0}
-
-    if command_translated == "set_temps":
-        return {"driver_temp": model.VEHICLE_TEMP}
-
-    if command_translated == "set_charge_limit":
-        return {"percent": model.VEHICLE_CHARGE_LIMIT}
+def resolve_command(model: RequestModel):
+    command_translated, body_params = COMMAND_ADAPTER[model.INPUT_CMD]
+    if isinstance(body_params, tuple):
+        param, field = body_params
+        body_params = {param: getattr(model, field)}
 
-    return {}
+    return command_translated, body_params
 
 
 def setup_telegram():
-    global TELEGRAM_BOT, TELEGRAM_CHAT_ID
-    if os.path.exists(TELEGRAM_CONFIG):
+    if not os.path.exists(TELEGRAM_CONFIG):
+        return None, None
+
+    try:
         with open(TELEGRAM_CONFIG) as json_file:
             data = json.load(json_file)
-            TELEGRAM_BOT = Bot(token=data["token"])
-            TELEGRAM_CHAT_ID = data["chatId"]
+            return Bot(token=data["token"]), data["chatId"]
+    except (OSError, ValueError, KeyError, InvalidToken) as e:
+        logger.exception("Invalid Telegram config %s, notifications are disabled: %s", TELEGRAM_CONFIG, e)
+        return None, None
+
 
+# Azure Functions imports the module once per worker, so the bot is only set up once
+TELEGRAM_BOT, TELEGRAM_CHAT_ID = setup_telegram()
 
-def force_wakeup(model: RequestModel):
 
-    tesla_awake = __is_tesla_awake(model)
-    counter = 0
-    while not tesla_awake:
-        time.sleep(2)
-        tesla_awake = __is_tesla_awake(model)
+def force_wakeup(vehicle_id: str, headers: dict):
+    # the wake_up calls themselves can take several seconds (timeouts and retries), so track wall clock time
+    deadline = time.monotonic() + TIMEOUT_WAKEUP
+    if __is_tesla_awake(vehicle_id, headers):
+        # Tesla was online already, no need to give it time to wakeup
+        return
 
-        counter += 2
-        if counter > TIMEOUT_WAKEUP:
+    delay = WAKEUP_DELAY_MIN
+    while True:
+        time.sleep(delay)
+        if __is_tesla_awake(vehicle_id, headers):
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
             raise TimeoutError("Waited %i seconds for Tesla to wakeup but it didn't!" % TIMEOUT_WAKEUP)
+        delay = min(delay * 2, WAKEUP_DELAY_MAX, remaining)
 
     # wait 2 seconds before executing next command (give Tesla to actually wakeup)
     time.sleep(2)
 
 
-def __is_tesla_awake(model: RequestModel):
-    resp = requests.post(os.path.join(TESLA_API_BASE, model.VEHICLE_ID, "wake_up"),
-                         headers={"Authorization": "Bearer %s" % model.TOKEN})
-    resp_content = resp.json()
+def __is_tesla_awake(vehicle_id: str, headers: dict):
+    resp = WAKEUP_SESSION.post(f"{TESLA_API_BASE}/{vehicle_id}/wake_up", headers=headers,
+                               timeout=TIMEOUT_WAKEUP_POLL)
+    resp_content = orjson.loads(resp.content)
 
     if "response" not in resp_content or "state" not in resp_content["response"]:
         raise KeyError("Wakeup Response looks unfamiliar: %s" % resp_content)
@@ -188,8 +240,15 @@ def respond(message, command: str = "", status_code: int = 200):
         else:
             telegram_message = response
 
-        TELEGRAM_BOT.send_message(text=json.dumps(telegram_message), chat_id=TELEGRAM_CHAT_ID)
+        future = TELEGRAM_EXECUTOR.submit(TELEGRAM_BOT.send_message,
+                                          text=orjson.dumps(telegram_message).decode(), chat_id=TELEGRAM_CHAT_ID)
+        future.add_done_callback(__log_telegram_error)
 
-    return func.HttpResponse(json.dumps(response),
+    return func.HttpResponse(orjson.dumps(response),
                              status_code=status_code,
                              headers={"Content-Type": "application/json"})
+
+
+def __log_telegram_error(future):
+    if future.exception() is not None:
+        logger.error("Sending Telegram message failed", exc_info=future.exception())